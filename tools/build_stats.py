@@ -16,21 +16,47 @@ components.
 """
 
 import argparse
+import array
 import collections
-import itertools
+import concurrent.futures
+import functools
+import heapq
 import json
+import mmap
 import os
-import re
+import pickle
+import shutil
 import struct
 import subprocess
 import sys
-import tempfile
 
 # Ignore functions with stack size smaller than this value.
 MIN_STACK_SIZE = 32
 
+# Number of functions with the largest stack size to print.
+TOP_STACK_ENTRIES = 20
 
-Symbol = collections.namedtuple('Symbol', ['address', 'size', 'typ', 'name'])
+# Maps every byte value to 0x80 if it has the LEB128 continuation bit set or to
+# 0 otherwise, for use with bytes.translate().
+LEB128_CONTINUATION_BITS = bytes(b & 0x80 for b in range(256))
+
+# Minimum number of consecutive .stack_sizes records with a single byte stack
+# size to decode them in bulk instead of one at a time.
+STACK_SIZES_MIN_BULK = 8
+
+
+# Version of the format of the symbols cache file. This must be updated when
+# the SymbolTable type changes.
+SYMBOLS_CACHE_VERSION = 3
+
+# The symbols of a file, stored as parallel sequences with one entry per symbol
+# instead of one object per symbol. addresses and sizes are arrays of unsigned
+# integers where a missing value is stored as 0, types is a string with the
+# lowercase type letter of each symbol, is_global is a bytes object with a 1 for
+# the symbols with an uppercase (global) type letter in nm and 0 otherwise, and
+# names is a list of the symbol names.
+SymbolTable = collections.namedtuple(
+    'SymbolTable', ['addresses', 'sizes', 'types', 'is_global', 'names'])
 
 # Represents the stack size information of a function (defined by its address).
 SymbolStack = collections.namedtuple('SymbolStack',
@@ -60,30 +86,173 @@ IGNORE_SYMBOLS = 'ua'
 SIMD_NAMESPACES = [
     'N_SCALAR', 'N_WASM', 'N_NEON', 'N_PPC8', 'N_SSE4', 'N_AVX2', 'N_AVX3']
 
+# The SIMD namespaces as they appear in mangled symbol names.
+SIMD_MANGLED_NAMESPACES = [(namespace, str(len(namespace)) + namespace)
+                           for namespace in SIMD_NAMESPACES]
 
-def LoadSymbols(filename):
-  ret = []
-  nmout = subprocess.check_output(['nm', '--format=posix', filename])
-  for line in nmout.decode('utf-8').splitlines():
-    if line.rstrip().endswith(':'):
-      # Ignore object names.
-      continue
-    # symbol_name, symbol_type, (optional) address, (optional) size
-    symlist = line.rstrip().split(' ')
-    assert 2 <= len(symlist) <= 4
-    ret.append(Symbol(
-        int(symlist[2], 16) if len(symlist) > 2 else None,
-        int(symlist[3], 16) if len(symlist) > 3 else None,
-        symlist[1],
-        symlist[0]))
+
+@functools.lru_cache(maxsize=None)
+def FindTool(name, prefix=''):
+  """Returns the absolute path of a tool, preferring the prefixed one.
+
+  Resolving the path once avoids a $PATH lookup on every run of the tool. If
+  the tool is not found its name is returned so running it fails as usual.
+  """
+  for tool in (prefix + name, name):
+    path = shutil.which(tool)
+    if path:
+      return path
+  return name
+
+
+def LoadSymbolsBatch(filenames, nm='nm'):
+  """Loads the symbols of all the passed files with a single nm invocation.
+
+  Returns a dictionary mapping each filename to its SymbolTable. The addresses
+  are only used to find the functions listed in the .stack_sizes section, which
+  is never loaded from static libraries, so they are not parsed for the
+  symbols of .a files and are all 0 there.
+  """
+  if not filenames:
+    return {}
+  # The addresses, sizes, types and names of the symbols of each file.
+  columns = {fn: ([], [], [], []) for fn in filenames}
+  cmd = [nm, '--format=posix'] + filenames
+  # Parse the nm output while it runs instead of buffering all of it, since it
+  # can be hundreds of MB for large targets.
+  with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1 << 20,
+                        encoding='utf-8', close_fds=False) as proc:
+    # nm prints a "filename:" header before the symbols of each file when more
+    # than one file is passed, and a "filename[member.o]:" header before each
+    # member of an archive. A single non-archive file has no header at all.
+    file_idx = 0
+    with_addresses = not filenames[0].endswith('.a')
+    # Local aliases to avoid the attribute lookups on every line.
+    (add_address, add_size, add_type, add_name) = (
+        column.append for column in columns[filenames[0]])
+    for line in proc.stdout:
+      if line.endswith(':\n'):
+        header = line[:-2]
+        # Files without symbols have no header, so search forward for the file
+        # this header belongs to.
+        for i in range(file_idx, len(filenames)):
+          if header == filenames[i] or header.startswith(filenames[i] + '['):
+            file_idx = i
+            with_addresses = not filenames[i].endswith('.a')
+            (add_address, add_size, add_type, add_name) = (
+                column.append for column in columns[filenames[i]])
+            break
+        continue
+      # symbol_name, symbol_type, (optional) address, (optional) size
+      symlist = line.split()
+      if len(symlist) == 4:
+        name, typ, address, size = symlist
+        add_address(int(address, 16) if with_addresses else 0)
+        add_size(int(size, 16))
+      elif len(symlist) == 3:
+        name, typ, address = symlist
+        add_address(int(address, 16) if with_addresses else 0)
+        add_size(0)
+      else:
+        name, typ = symlist
+        add_address(0)
+        add_size(0)
+      add_type(typ)
+      add_name(name)
+  if proc.returncode:
+    raise subprocess.CalledProcessError(proc.returncode, cmd)
+  ret = {}
+  for fn, (addresses, sizes, types, names) in columns.items():
+    types = ''.join(types)
+    # Lowercase the types once here since all the users need them lowercase.
+    ret[fn] = SymbolTable(array.array('Q', addresses), array.array('Q', sizes),
+                          types.lower(), bytes(map(str.isupper, types)), names)
+  return ret
+
+
+def SymbolType(typ, is_global):
+  """Returns the type letter of a symbol as printed by nm."""
+  return typ.upper() if is_global else typ
+
+
+def LoadSymbolsParallel(filenames, nm='nm'):
+  """Loads the symbols of all the passed files using one process per CPU.
+
+  Returns a dictionary mapping each filename to its SymbolTable.
+  """
+  jobs = min(os.cpu_count() or 1, len(filenames))
+  if jobs <= 1:
+    return LoadSymbolsBatch(filenames, nm)
+  # Distribute the files, largest first, in round robin so every process gets
+  # a similar amount of work, and load each set of files with a single nm.
+  by_size = sorted(filenames, key=os.path.getsize, reverse=True)
+  ret = {}
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+    for job_syms in executor.map(LoadSymbolsBatch,
+                                 [by_size[i::jobs] for i in range(jobs)],
+                                 [nm] * jobs):
+      ret.update(job_syms)
+  return ret
+
+
+def LoadSymbolsCached(filenames, cache_path, nm='nm'):
+  """Loads the symbols of all the passed files using an on-disk cache.
+
+  The cache stores the symbols of each file together with its modification
+  time and size, and only the files not in the cache or changed since they
+  were cached are loaded with nm. An empty cache_path disables the cache.
+  """
+  if not cache_path:
+    return LoadSymbolsParallel(filenames, nm)
+  cache = {}
+  try:
+    with open(cache_path, 'rb') as f:
+      version, cache = pickle.load(f)
+    if version != SYMBOLS_CACHE_VERSION:
+      cache = {}
+  except Exception:
+    # A missing, corrupted or incompatible cache is just ignored.
+    cache = {}
+
+  ret = {}
+  missing = []
+  for fn in filenames:
+    st = os.stat(fn)
+    key = (st.st_mtime_ns, st.st_size)
+    cached = cache.get(os.path.abspath(fn))
+    if cached is not None and cached[0] == key:
+      ret[fn] = cached[1]
+    else:
+      missing.append((fn, key))
+  if not missing:
+    return ret
+
+  ret.update(LoadSymbolsParallel([fn for fn, _ in missing], nm))
+  for fn, key in missing:
+    cache[os.path.abspath(fn)] = (key, ret[fn])
+  cache_dir = os.path.dirname(cache_path)
+  if cache_dir:
+    os.makedirs(cache_dir, exist_ok=True)
+  # Write to a temporary file first so concurrent runs never see a partially
+  # written cache.
+  tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+  with open(tmp_path, 'wb') as f:
+    pickle.dump((SYMBOLS_CACHE_VERSION, cache), f,
+                protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp_path, cache_path)
   return ret
 
+
+# Several targets, like a library and its symlink, resolve to the same ninja
+# target, so cache the commands to run ninja only once per target.
+@functools.lru_cache(maxsize=None)
 def LoadTargetCommand(target, build_dir):
   stdout = subprocess.check_output(
-      ['ninja', '-C', build_dir, '-t', 'commands', target])
+      [FindTool('ninja'), '-C', build_dir, '-t', 'commands', target],
+      close_fds=False)
   # The last command is always the command to build (link) the requested
   # target.
-  command = stdout.splitlines()[-1]
+  command = stdout.rstrip(b'\n').rsplit(b'\n', 1)[-1]
   return command.decode('utf-8')
 
 
@@ -138,69 +307,165 @@ def TargetTransitiveDeps(all_tgts, target):
   return ret
 
 
-def LoadStackSizes(filename, binutils=''):
+def ElfPointerFormat(elf):
+  """Returns the struct format of a pointer in the given ELF file contents."""
+  # The e_ident field at the start of the ELF header has the class (32 or 64
+  # bits) at offset 4 and the data encoding (endianness) at offset 5.
+  ident = elf[:6]
+  if len(ident) < 6 or ident[:4] != b'\x7fELF':
+    raise Exception('Not an ELF file')
+  if ident[5] != 1:
+    raise Exception('Unsupported big-endian ELF file')
+  if ident[4] == 2:
+    return '<Q'
+  elif ident[4] == 1:
+    return '<I'
+  raise Exception('Unknown ELF class %d' % ident[4])
+
+
+def LoadElfSection(elf, section_name):
+  """Returns the contents of the named section from the ELF file contents.
+
+  If there are multiple sections with the same name their contents are
+  concatenated in the order they appear in the section header table. Returns
+  an empty bytes object if there is no such section.
+  """
+  if ElfPointerFormat(elf) == '<Q':
+    # e_shoff, e_flags, e_ehsize, e_phentsize, e_phnum, e_shentsize, e_shnum,
+    # e_shstrndx from the Elf64_Ehdr.
+    ehdr_fmt = '<40xQIHHHHHH'
+    # sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link from
+    # the Elf64_Shdr.
+    shdr_fmt = '<IIQQQQI'
+  else:
+    ehdr_fmt = '<32xIIHHHHHH'
+    shdr_fmt = '<IIIIIII'
+  shoff, _, _, _, _, shentsize, shnum, shstrndx = struct.unpack_from(
+      ehdr_fmt, elf, 0)
+  if not shoff:
+    return b''
+
+  def SectionHeader(index):
+    name, _, _, _, offset, size, link = struct.unpack_from(
+        shdr_fmt, elf, shoff + index * shentsize)
+    return name, offset, size, link
+
+  # Files with a large number of sections store the real number of sections
+  # and the section name string table index in the first section header.
+  _, _, first_size, first_link = SectionHeader(0)
+  if shnum == 0:
+    shnum = first_size
+  if shstrndx == 0xffff:  # SHN_XINDEX
+    shstrndx = first_link
+  _, strtab_offset, strtab_size, _ = SectionHeader(shstrndx)
+  strtab = elf[strtab_offset:strtab_offset + strtab_size]
+  target_name = section_name.encode('utf-8') + b'\0'
+
+  ret = []
+  for index in range(1, shnum):
+    name, offset, size, _ = SectionHeader(index)
+    if strtab.startswith(target_name, name):
+      ret.append(elf[offset:offset + size])
+  return b''.join(ret)
+
+
+def LoadStackSizes(filename):
   """Loads the stack size used by functions from the ELF.
 
   This function loads the stack size the compiler stored in the .stack_sizes
   section, which can be done by compiling with -fstack-size-section in clang.
   """
-  with tempfile.NamedTemporaryFile() as stack_sizes_sec:
-    subprocess.check_call(
-        [binutils + 'objcopy', '-O', 'binary', '--only-section=.stack_sizes',
-         '--set-section-flags', '.stack_sizes=alloc', filename,
-         stack_sizes_sec.name])
-    stack_sizes = stack_sizes_sec.read()
+  with open(filename, 'rb') as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as elf:
+      pointer_fmt = ElfPointerFormat(elf)
+      stack_sizes = LoadElfSection(elf, '.stack_sizes')
   # From the documentation:
   #  The section will contain an array of pairs of function symbol values
   #  (pointer size) and stack sizes (unsigned LEB128). The stack size values
   #  only include the space allocated in the function prologue. Functions with
   #  dynamic stack allocations are not included.
 
-  # Get the pointer format based on the ELF file.
-  output = subprocess.check_output(
-      [binutils + 'objdump', '-a', filename]).decode('utf-8')
-  elf_format = re.search('file format (.*)$', output, re.MULTILINE).group(1)
-  if elf_format.startswith('elf64-little') or elf_format == 'elf64-x86-64':
-    pointer_fmt = '<Q'
-  elif elf_format.startswith('elf32-little') or elf_format == 'elf32-i386':
-    pointer_fmt = '<I'
-  else:
-    raise Exception('Unknown ELF format: %s' % elf_format)
   pointer_size = struct.calcsize(pointer_fmt)
+  # Most functions use less than 128 bytes of stack, so their size is a single
+  # LEB128 byte and the record has a fixed size: a pointer followed by a byte.
+  short_record = struct.Struct(pointer_fmt + 'B')
+  short_record_size = short_record.size
+  unpack_pointer = struct.Struct(pointer_fmt).unpack_from
+
+  # The stack size bytes of consecutive short records starting at a given
+  # offset modulo short_record_size, with the LEB128 continuation bit of each
+  # one mapped to 0x80 and everything else to 0. There are only
+  # short_record_size possible alignments so these are computed once.
+  size_bytes_by_alignment = {}
 
   ret = []
   i = 0
   while i < len(stack_sizes):
-    assert len(stack_sizes) >= i + pointer_size
-    addr, = struct.unpack_from(pointer_fmt, stack_sizes, i)
-    i += pointer_size
-    # Parse LEB128
-    size = 0
-    for j in range(10):
-      b = stack_sizes[i]
+    # Find the next multi-byte LEB128 stack size assuming all the records
+    # from i are short, and decode in bulk all the short records before it.
+    alignment = i % short_record_size
+    if alignment not in size_bytes_by_alignment:
+      size_bytes_by_alignment[alignment] = stack_sizes[
+          alignment + pointer_size::short_record_size].translate(
+              LEB128_CONTINUATION_BITS)
+    size_bytes = size_bytes_by_alignment[alignment]
+    first = i // short_record_size
+    last = size_bytes.find(0x80, first)
+    if last < 0:
+      last = len(size_bytes)
+    num_short = last - first
+    if num_short >= STACK_SIZES_MIN_BULK:
+      short_end = i + num_short * short_record_size
+      ret.extend(SymbolStack(addr, size) for addr, size in
+                 short_record.iter_unpack(stack_sizes[i:short_end])
+                 if size >= MIN_STACK_SIZE)
+      i = short_end
+
+    # Decode the records one at a time until the next run of short records
+    # long enough to decode in bulk.
+    num_short = 0
+    while i < len(stack_sizes) and num_short < STACK_SIZES_MIN_BULK:
+      assert len(stack_sizes) >= i + pointer_size
+      addr, = unpack_pointer(stack_sizes, i)
+      i += pointer_size
+      # Parse LEB128, with the single byte case out of the loop.
+      size = stack_sizes[i]
       i += 1
-      size += (b & 0x7f) << (7 * j)
-      if (b & 0x80) == 0:
-        break
-    if size >= MIN_STACK_SIZE:
-      ret.append(SymbolStack(addr, size))
+      if size & 0x80:
+        num_short = 0
+        size &= 0x7f
+        for j in range(1, 10):
+          b = stack_sizes[i]
+          i += 1
+          size += (b & 0x7f) << (7 * j)
+          if (b & 0x80) == 0:
+            break
+      else:
+        num_short += 1
+      if size >= MIN_STACK_SIZE:
+        ret.append(SymbolStack(addr, size))
   return ret
 
 
-def TargetSize(symbols, symbol_filter=None):
-  ret = {}
-  for sym in symbols:
-    if not sym.size or (symbol_filter is not None and
-                        sym.name not in symbol_filter):
+def TargetSize(symbols, symbol_filter=None, merged_syms=None):
+  """Returns the size of the symbols in a SymbolTable per symbol type.
+
+  If symbol_filter is passed, only the symbols with a name in symbol_filter and
+  not in merged_syms are counted, and the names of the counted symbols that the
+  linker merges across objects are added to merged_syms.
+  """
+  ret = collections.defaultdict(int)
+  for size, typ, is_global, name in zip(symbols.sizes, symbols.types,
+                                        symbols.is_global, symbols.names):
+    if not size or (symbol_filter is not None and
+                    (name not in symbol_filter or name in merged_syms)):
       continue
-    t = sym.typ.lower()
     # We can remove symbols if they appear in multiple objects since they will
     # be merged by the linker.
-    if symbol_filter is not None and (t == sym.typ or t in 'wv'):
-      symbol_filter.remove(sym.name)
-    ret.setdefault(t, 0)
-    ret[t] += sym.size
-  return ret
+    if symbol_filter is not None and (not is_global or typ in 'wv'):
+      merged_syms.add(name)
+    ret[typ] += size
+  return dict(ret)
 
 
 def PrintStats(stats):
@@ -230,33 +495,35 @@ def PrintStats(stats):
   table.append(('-- unknown --', mx_bin_size - sum_bin_size,
                 mx_ram_size - sum_ram_size))
 
-  # Print the table
-  print('%-32s %17s %17s' % ('Object name', 'Binary size', 'Static RAM size'))
+  # Print the table with a single write.
+  lines = ['%-32s %17s %17s' % (
+      'Object name', 'Binary size', 'Static RAM size')]
   for name, bin_size, ram_size in table:
-    print('%-32s %8d (%5.1f%%) %8d (%5.1f%%)' % (
+    lines.append('%-32s %8d (%5.1f%%) %8d (%5.1f%%)' % (
         name, bin_size, 100. * bin_size / mx_bin_size,
         ram_size, (100. * ram_size / mx_ram_size) if mx_ram_size else 0))
-  print()
+  lines.append('')
+  sys.stdout.write('\n'.join(lines) + '\n')
 
 
-def PrintStackStats(tgt_stack_sizes, top_entries=20):
-  if not tgt_stack_sizes:
+def PrintStackStats(top_stack_sizes):
+  if not top_stack_sizes:
     return
-  print(' Stack   Symbol name')
-  for i, (name, size) in zip(itertools.count(), tgt_stack_sizes.items()):
-    if top_entries > 0 and i >= top_entries:
-      break
-    print('%8d %s' % (size, name))
-  print()
+  lines = [' Stack   Symbol name']
+  for name, size in top_stack_sizes:
+    lines.append('%8d %s' % (size, name))
+  lines.append('')
+  sys.stdout.write('\n'.join(lines) + '\n')
 
 
 def PrintTopSymbols(tgt_top_symbols):
   if not tgt_top_symbols:
     return
-  print(' Size     T Symbol name')
+  lines = [' Size     T Symbol name']
   for size, typ, name in tgt_top_symbols:
-    print('%9d %s %s' % (size, typ, name))
-  print()
+    lines.append('%9d %s %s' % (size, typ, name))
+  lines.append('')
+  sys.stdout.write('\n'.join(lines) + '\n')
 
 
 def SizeStats(args):
@@ -285,10 +552,15 @@ def SizeStats(args):
   syms = {}
   # Load the symbols from the all targets and its deps.
   all_deps = set(tgts.keys()).union(*[set(tgt.deps) for tgt in tgts.values()])
-  for entry in all_deps:
-    fn = os.path.join(args.build_dir,
-                      tgts[entry].filename if entry in tgts else entry)
-    syms[entry] = LoadSymbols(fn)
+  dep_files = {entry: os.path.join(
+                   args.build_dir,
+                   tgts[entry].filename if entry in tgts else entry)
+               for entry in all_deps}
+  file_syms = LoadSymbolsCached(sorted(set(dep_files.values())),
+                                args.symbols_cache,
+                                FindTool('nm', args.binutils))
+  for entry, fn in dep_files.items():
+    syms[entry] = file_syms[fn]
 
   for target in args.target:
     tgt_stats = []
@@ -296,56 +568,79 @@ def SizeStats(args):
 
     tgt_syms = syms[target]
     used_syms = set()
-    for sym in tgt_syms:
-      if sym.typ.lower() in BIN_SIZE + RAM_SIZE:
-        used_syms.add(sym.name)
-      elif sym.typ.lower() in IGNORE_SYMBOLS:
+    for typ, is_global, name in zip(tgt_syms.types, tgt_syms.is_global,
+                                    tgt_syms.names):
+      if typ in BIN_SIZE + RAM_SIZE:
+        used_syms.add(name)
+      elif typ in IGNORE_SYMBOLS:
         continue
       else:
-        print('Unknown: %s %s' % (sym.typ, sym.name))
+        print('Unknown: %s %s' % (SymbolType(typ, is_global), name))
+    used_syms = frozenset(used_syms)
 
     target_path = os.path.join(args.build_dir, tgt.filename)
     sym_stacks = []
     if not target_path.endswith('.a'):
-      sym_stacks = LoadStackSizes(target_path, args.binutils)
-    symbols_by_addr = {sym.address: sym for sym in tgt_syms
-                          if sym.typ.lower() in 'tw'}
-    tgt_stack_sizes = collections.OrderedDict()
-    for sym_stack in sorted(sym_stacks, key=lambda s: -s.stack_size):
-      tgt_stack_sizes[
-          symbols_by_addr[sym_stack.address].name] = sym_stack.stack_size
+      sym_stacks = LoadStackSizes(target_path)
+    # Only the functions with a stack size entry are looked up by address.
+    stack_addrs = {sym_stack.address for sym_stack in sym_stacks}
+    names_by_addr = {
+        address: name for address, typ, name in zip(
+            tgt_syms.addresses, tgt_syms.types, tgt_syms.names)
+        if address in stack_addrs and typ in 'tw'}
+    top_stack_sizes = [
+        (names_by_addr[sym_stack.address], sym_stack.stack_size)
+        for sym_stack in heapq.nlargest(TOP_STACK_ENTRIES, sym_stacks,
+                                        key=lambda s: s.stack_size)]
+    # All the stack sizes, sorted from largest to smallest, are only needed in
+    # the saved stats.
+    tgt_stack_sizes = {}
+    if args.save:
+      for sym_stack in sorted(sym_stacks, key=lambda s: -s.stack_size):
+        tgt_stack_sizes[
+            names_by_addr[sym_stack.address]] = sym_stack.stack_size
 
     tgt_top_symbols = []
     if args.top_symbols:
-      tgt_top_symbols = [(sym.size, sym.typ, sym.name) for sym in tgt_syms
-                         if sym.name in used_syms and sym.size]
-      tgt_top_symbols.sort(key=lambda t: (-t[0], t[2]))
-      tgt_top_symbols = tgt_top_symbols[:args.top_symbols]
+      top_syms = [
+          sym for sym in zip(tgt_syms.sizes, tgt_syms.types,
+                             tgt_syms.is_global, tgt_syms.names)
+          if sym[3] in used_syms and sym[0]]
+      top_syms.sort(key=lambda t: (-t[0], t[3]))
+      tgt_top_symbols = [
+          (size, SymbolType(typ, is_global), name)
+          for size, typ, is_global, name in top_syms[:args.top_symbols]]
 
     tgt_size = TargetSize(tgt_syms)
     tgt_stats.append(ObjectStats(target, False, tgt_size))
 
     # Split out by SIMD.
-    for namespace in SIMD_NAMESPACES:
-      mangled = str(len(namespace)) + namespace
-      if not any(mangled in sym.name for sym in tgt_syms):
+    simd_sizes = {namespace: collections.defaultdict(int)
+                  for namespace in SIMD_NAMESPACES}
+    for size, typ, name in zip(tgt_syms.sizes, tgt_syms.types,
+                               tgt_syms.names):
+      # All the SIMD namespaces start with "N_", which quickly skips most of
+      # the other symbols.
+      if not size or 'N_' not in name:
         continue
-      ret = {}
-      for sym in tgt_syms:
-        if not sym.size or mangled not in sym.name:
+      for namespace, mangled in SIMD_MANGLED_NAMESPACES:
+        if mangled not in name:
           continue
-        t = sym.typ.lower()
-        ret.setdefault(t, 0)
-        ret[t] += sym.size
+        simd_sizes[namespace][typ] += size
+    for namespace in SIMD_NAMESPACES:
       # SIMD namespaces are not part of the partition, they are already included
       # in the jpegxl-static normally.
-      if not ret:
+      if not simd_sizes[namespace]:
         continue
-      tgt_stats.append(ObjectStats('\\--> ' + namespace, False, ret))
+      tgt_stats.append(ObjectStats('\\--> ' + namespace, False,
+                                   dict(simd_sizes[namespace])))
 
+    # Names of the symbols already counted in a previous object that the linker
+    # would merge with the ones in the following objects.
+    merged_syms = set()
     for obj in tgt.deps:
-      dep_used_syms = used_syms.copy()
-      obj_size = TargetSize(syms[obj], used_syms)
+      dep_merged_syms = merged_syms.copy()
+      obj_size = TargetSize(syms[obj], used_syms, merged_syms)
       if not obj_size:
         continue
       tgt_stats.append(ObjectStats(os.path.basename(obj), True, obj_size))
@@ -354,14 +649,14 @@ def SizeStats(args):
         # level.
         for obj_dep in sorted(TargetTransitiveDeps(tgts, obj),
                               key=os.path.basename):
-          obj_dep_size = TargetSize(syms[obj_dep], dep_used_syms)
+          obj_dep_size = TargetSize(syms[obj_dep], used_syms, dep_merged_syms)
           if not obj_dep_size:
             continue
           tgt_stats.append(ObjectStats(
               '   '+ os.path.basename(obj_dep), False, obj_dep_size))
 
     PrintStats(tgt_stats)
-    PrintStackStats(tgt_stack_sizes)
+    PrintStackStats(top_stack_sizes)
     PrintTopSymbols(tgt_top_symbols)
     stats[target] = {
         'build': tgt_stats,
@@ -376,12 +671,14 @@ def SizeStats(args):
   # Check the maximum stack size.
   exit_code = 0
   if args.max_stack:
-    for name, size in tgt_stack_sizes.items():
-      if size > args.max_stack:
-        print('Error: %s exceeds stack limit: %d vs %d' % (
-                  name, size, args.max_stack),
-              file=sys.stderr)
-        exit_code = 1
+    large_stacks = [sym_stack for sym_stack in sym_stacks
+                    if sym_stack.stack_size > args.max_stack]
+    for sym_stack in sorted(large_stacks, key=lambda s: -s.stack_size):
+      print('Error: %s exceeds stack limit: %d vs %d' % (
+                names_by_addr[sym_stack.address], sym_stack.stack_size,
+                args.max_stack),
+            file=sys.stderr)
+      exit_code = 1
 
   return exit_code
 
@@ -397,6 +694,13 @@ def main():
                       help='Print recursive entries.')
   parser.add_argument('--top-symbols', default=0, type=int,
                       help='Number of largest symbols to print')
+  parser.add_argument('--symbols-cache',
+                      default=os.path.join(
+                          os.environ.get('XDG_CACHE_HOME',
+                                         os.path.expanduser('~/.cache')),
+                          'jxl-build-stats', 'symbols.pkl'),
+                      help='path to the cache of the symbols of the loaded '
+                           'files, or an empty string to disable it')
   parser.add_argument('--binutils', default='',
                       help='prefix path to binutils tools, such as '
                            'aarch64-linux-gnu-')